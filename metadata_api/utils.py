@@ -64,7 +64,7 @@ def read_static_json(jsonfile):
     """Load json file from static folder and return as object."""
     print("Reading json", jsonfile)  # noqa: T201
     file_path = Path(current_app.config.get("STATIC")) / jsonfile
-    with file_path.open("r") as f:
+    with file_path.open("r", encoding="utf-8") as f:
         return json.load(f)
 
 
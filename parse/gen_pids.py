@@ -3,16 +3,22 @@
 import argparse #standard
 import datetime #standard
 import netrc #standard
+import os #standard
 import re #standard
 import sys #standard
 import traceback #standard
+from collections import defaultdict #standard
+from concurrent.futures import ThreadPoolExecutor, as_completed #standard
+from functools import lru_cache #standard
 from pathlib import Path #standard
-from typing import Optional #standard
+from typing import Iterator, Optional #standard
 from bs4 import BeautifulSoup #install
 import markdown #install
 
+import orjson
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 try:
@@ -20,6 +26,7 @@ try:
     DOI_KEY = "doi"
     DMS_URL = "https://api.datacite.org/dois"
     DMS_AUTH_USER, DMS_AUTH_ACCOUNT, DMS_AUTH_PASSWORD = netrc.netrc().authenticators("datacite.org")
+    DMS_AUTH = HTTPBasicAuth(DMS_AUTH_USER, DMS_AUTH_PASSWORD)
     DMS_HEADERS = {"content-type": "application/json"}
     DMS_PREFIX = "10.23695"
     DMS_REPOID = "SND.SPRKB"
@@ -33,20 +40,38 @@ try:
     DMS_DEFAULT_YEAR = "2024"  # Set for resources without a date
     DMS_SLUG = "slug"  # Språkbanken Texts resource ID ("slug") type
     DMS_HANDLE = "handle"
+    DMS_PAGE_SIZE = 1000  # Max number of records per page when listing DOIs
     DMS_LANG_ENG = "en"
     DMS_LANG_SWE = "sv"
     DMS_LANG_MUL = "mul"
     DMS_TITLE_EXAMPLE_SWE = "Exempel (in English)"
     DMS_TITLE_EXAMPLE_ENG = "Example"
+    DMS_PUBLISHER = {
+        "name": DMS_CREATOR_NAME,
+        "publisherIdentifier": DMS_CREATOR_ROR,
+        "publisherIdentifierScheme": "ROR",
+        "schemeURI": "https://ror.org/",
+    }
+    DMS_SUBJECT = {
+        "subject": "Language Technology (Computational Linguistics)",
+        "subjectScheme": "Standard för svensk indelning av forskningsämnen 2011",
+        "classificationCode": "10208",
+        "schemeURI": "https://www.scb.se/dokumentation/klassifikationer-och-standarder/standard-for-svensk-indelning-av-forskningsamnen",
+    }
 
     DMS_RELATION_TYPE_ISPARTOF = "IsPartOf"
     DMS_RELATION_TYPE_HASPART = "HasPart"
     DMS_RELATION_TYPE_ISOBSOLETEDBY = "IsObsoletedBy"
     DMS_RELATION_TYPE_OBSOLETES = "Obsoletes"
 
+    DMS_MAX_WORKERS = 4  # Max number of concurrent requests to Datacite (mind the rate limit)
+
     RESPONSE_OK = 200
     RESPONSE_CREATED = 201
 
+    # Keep-alive session for Datacite requests
+    DMS_SESSION = requests.Session()
+    DMS_SESSION.mount("https://", HTTPAdapter(pool_maxsize=DMS_MAX_WORKERS))
 
 except Exception:
     print("gen_pids: Failed init. Exiting.", file=sys.stderr)
@@ -54,6 +79,15 @@ except Exception:
     sys.exit()
 
 
+# Use the libyaml based loader if PyYAML was built with it, it is many times faster than the pure Python one
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Used by get_clean_string
+BLANK_LINES_RE = re.compile(r"\n\s*\n")
+MD_FENCE_LANG_RE = re.compile(r"(^\s*```)[^\s`]+\n", re.MULTILINE)
+MARKDOWN = markdown.Markdown()  # Reused (after reset) for every string
+
+
 # Instantiate command line arg parser
 parser = argparse.ArgumentParser(
     description="Read YAML metadata files, create DOIs for those that are missing it, "
@@ -87,27 +121,28 @@ def main(param_debug: bool = False, param_test: bool = False, param_noupdate: bo
     # 1. Get all resources
 
     resources = {}
+    datasets = {}  # is_dataset() for every resource, computed once
     files_yaml = {}
 
     if param_debug:
         print("gen_pids/main: Reading resources from YAML.")
 
     if param_file == None:
-        # Path.glob(pattern, *, case_sensitive=None) - returns list of found files
-        # **/*.yaml - all files in this dir and subdirs, recursively
-        for filepath in sorted(YAML_DIR.glob("**/*.yaml")):
+        # All YAML files in YAML_DIR and its subdirs, recursively
+        for res_id, filepath in sorted(iter_yaml(YAML_DIR)):
             # Get resources from yaml
             try:
-                res_id = filepath.stem
                 files_yaml[res_id] = filepath
-                with filepath.open(encoding="utf-8") as file_yaml:
-                    res = yaml.safe_load(file_yaml)
+                with open(filepath, "rb") as file_yaml:
+                    res = yaml.load(file_yaml.read(), Loader=YAML_LOADER)  # noqa: S506
                     if not get_key_value(res, "unlisted"):
-                        if param_analyses or is_dataset(res):
+                        res_is_dataset = is_dataset(res)
+                        if param_analyses or res_is_dataset:
                             resources[res_id] = res
+                            datasets[res_id] = res_is_dataset
 
             except Exception:
-                print(f"gen_pids/main: Error when opening/reading YAML file {filepath.stem}" , file=sys.stderr)
+                print(f"gen_pids/main: Error when opening/reading YAML file {res_id}" , file=sys.stderr)
                 # print(traceback.format_exc(), file=sys.stderr)
                 # sys.exit()
     else:
@@ -119,11 +154,13 @@ def main(param_debug: bool = False, param_test: bool = False, param_noupdate: bo
         try:
             res_id = filepath.stem
             files_yaml[res_id] = filepath
-            with filepath.open(encoding="utf-8") as file_yaml:
-                res = yaml.safe_load(file_yaml)
+            with filepath.open("rb") as file_yaml:
+                res = yaml.load(file_yaml.read(), Loader=YAML_LOADER)  # noqa: S506
                 if not get_key_value(res, "unlisted"):
-                    if param_analyses or is_dataset(res):
+                    res_is_dataset = is_dataset(res)
+                    if param_analyses or res_is_dataset:
                         resources[res_id] = res
+                        datasets[res_id] = res_is_dataset
 
         except Exception:
             print("gen_pids/main: Error when opening single YAML file. Exiting.", file=sys.stderr)
@@ -133,16 +170,30 @@ def main(param_debug: bool = False, param_test: bool = False, param_noupdate: bo
     # 2. Assign DOIs
     if param_debug:
         print(f"gen_pids/main: Assign DOIs to {len(resources)} resources.")
+
+    # Get all records registered at Datacite at once instead of one request per resource
+    # (searching for resources without DOI, getting dates for resources that may need an update)
+    existing_dois = None
+    dms_dates = None
+    if not param_noupdate or any(res and DOI_KEY not in res for res in resources.values()):
+        dms_records = dms_doi_list(param_debug)
+        if dms_records is not None:
+            existing_dois = get_slug_dois(dms_records)
+            dms_dates = {record["id"].lower(): get_dms_dates(record) for record in dms_records if record.get("id")}
+
     for res_id, res in resources.items():
         try:
             if param_debug:
                 print("gen_pids/main: Work on", res_id)
             if res:
-                res_is_dataset = is_dataset(res)
+                res_is_dataset = datasets[res_id]
                 # does the resource already have a DOI?
                 if DOI_KEY not in res:
                     # does resource it already exists at Datacite? (a new metadata-YAMl could have been autogenerated)
-                    doi = dms_doi_get(res_id, param_debug)
+                    if existing_dois is not None:
+                        doi = existing_dois.get(res_id, "")
+                    else:
+                        doi = dms_doi_get(res_id, param_debug)
                     if not doi:
                         # generate DOI and Datacite metadata record
                         doi = dms_new(res_id, res, res_is_dataset, param_debug, param_test)
@@ -153,24 +204,14 @@ def main(param_debug: bool = False, param_test: bool = False, param_noupdate: bo
                         if not param_test:
                             # add line with "doi:" to YAML
                             try:
-                                with files_yaml[res_id].open(mode="r+", encoding="utf-8") as file_yaml:
-                                    # find out if last char is \n
-                                    while True:
-                                        char = file_yaml.read(1)
-                                        if not char:
-                                            break
-                                        last_char_is_newline = (char == "\n")
-                                    if last_char_is_newline:
-                                        file_yaml.write(f"doi: {doi}\n")
-                                    else:
-                                        file_yaml.write(f"\ndoi: {doi}\n")
+                                add_yaml_line(files_yaml[res_id], f"{DOI_KEY}: {doi}")
                             except Exception:
                                 print("gen_pids/main: Error adding DOI to YAML", res_id, doi, file=sys.stderr)
                     else:
                         print("gen_pids/main: Error creating DOI for YAML", res_id, doi, file=sys.stderr)
                 else:
                     if not param_noupdate:
-                        dms_update(res_id, res, res_is_dataset, param_debug, param_test)
+                        dms_update(res_id, res, res_is_dataset, param_debug, param_test, dms_dates)
         except Exception:
             print(f"gen_pids/main: Error when working on {res_id}", file=sys.stderr)
             print(traceback.format_exc(), file=sys.stderr)
@@ -187,42 +228,20 @@ def main(param_debug: bool = False, param_test: bool = False, param_noupdate: bo
     """
 
     if not param_noupdate:
-        c = {}
+        c = defaultdict(lambda: defaultdict(set))
         for res_id, res in resources.items():
             try:
                 if param_debug:
                     print("gen_pids/main: Map collections for", res_id)
-                if get_key_value(res, "collection") and res_id not in c:
-                    c[res_id] = {}
-                    c[res_id][DMS_RELATION_TYPE_HASPART] = []
-                member_list = get_key_list_value(res, "resources")
-                if member_list:
-                    for member_res_id in member_list:
-                        if member_res_id not in c:
-                            c[member_res_id] = {}
-                            c[member_res_id][DMS_RELATION_TYPE_ISPARTOF] = []
-                        if res_id not in c:
-                            c[res_id] = {}
-                        if DMS_RELATION_TYPE_HASPART not in c[res_id]:
-                            c[res_id][DMS_RELATION_TYPE_HASPART] = []
-                        if member_res_id not in c[res_id][DMS_RELATION_TYPE_HASPART]:
-                            c[res_id][DMS_RELATION_TYPE_HASPART].append(member_res_id)
-                        if res_id not in c[member_res_id][DMS_RELATION_TYPE_ISPARTOF]:
-                            c[member_res_id][DMS_RELATION_TYPE_ISPARTOF].append(res_id)
-                parent_list = get_key_list_value(res, "in_collections")
-                if parent_list:
-                    for parent_res_id in parent_list:
-                        if parent_res_id not in c:
-                            c[parent_res_id] = {}
-                            c[parent_res_id][DMS_RELATION_TYPE_HASPART] = []
-                        if res_id not in c:
-                            c[res_id] = {}
-                        if DMS_RELATION_TYPE_ISPARTOF not in c[res_id]:
-                            c[res_id][DMS_RELATION_TYPE_ISPARTOF] = []
-                        if parent_res_id not in c[res_id][DMS_RELATION_TYPE_ISPARTOF]:
-                            c[res_id][DMS_RELATION_TYPE_ISPARTOF].append(parent_res_id)
-                        if res_id not in c[parent_res_id][DMS_RELATION_TYPE_HASPART]:
-                            c[parent_res_id][DMS_RELATION_TYPE_HASPART].append(res_id)
+                if get_key_value(res, "collection"):
+                    # Make sure collections without members get their relations reset as well
+                    c[res_id].setdefault(DMS_RELATION_TYPE_HASPART, set())
+                for member_res_id in get_key_list_value(res, "resources"):
+                    c[res_id][DMS_RELATION_TYPE_HASPART].add(member_res_id)
+                    c[member_res_id][DMS_RELATION_TYPE_ISPARTOF].add(res_id)
+                for parent_res_id in get_key_list_value(res, "in_collections"):
+                    c[res_id][DMS_RELATION_TYPE_ISPARTOF].add(parent_res_id)
+                    c[parent_res_id][DMS_RELATION_TYPE_HASPART].add(res_id)
             except Exception:  # noqa: PERF203
                 print("gen_pids/main: Error when mapping collections for", res_id, file=sys.stderr)
                 print(traceback.format_exc(), file=sys.stderr)
@@ -239,23 +258,9 @@ def main(param_debug: bool = False, param_test: bool = False, param_noupdate: bo
             try:
                 if param_debug:
                     print("gen_pids/main: Map successors for", res_id)
-                successor_list = get_key_list_value(res, "successors")
-                if successor_list:
-                    if res_id not in c:
-                        c[res_id] = {}
-                        c[res_id][DMS_RELATION_TYPE_ISOBSOLETEDBY] = successor_list
-                    else:
-                        if DMS_RELATION_TYPE_ISOBSOLETEDBY not in c[res_id]:
-                            c[res_id][DMS_RELATION_TYPE_ISOBSOLETEDBY] = []
-                        c[res_id][DMS_RELATION_TYPE_ISOBSOLETEDBY] += successor_list
-                    for successor_res_id in successor_list:
-                        if successor_res_id not in c:
-                            c[successor_res_id] = {}
-                            c[successor_res_id][DMS_RELATION_TYPE_OBSOLETES] = [res_id]
-                        else:
-                            if DMS_RELATION_TYPE_ISOBSOLETEDBY not in c[successor_res_id]:
-                                c[successor_res_id][DMS_RELATION_TYPE_ISOBSOLETEDBY] = []
-                            c[successor_res_id][DMS_RELATION_TYPE_ISOBSOLETEDBY].append(res_id)
+                for successor_res_id in get_key_list_value(res, "successors"):
+                    c[res_id][DMS_RELATION_TYPE_ISOBSOLETEDBY].add(successor_res_id)
+                    c[successor_res_id][DMS_RELATION_TYPE_OBSOLETES].add(res_id)
             except Exception:  # noqa: PERF203
                 print("gen_pids/main: Error when mapping successors for", res_id, file=sys.stderr)
                 print(traceback.format_exc(), file=sys.stderr)
@@ -268,24 +273,35 @@ def main(param_debug: bool = False, param_test: bool = False, param_noupdate: bo
         if param_debug:
             print("gen_pids/main: update relation metadata at Datacite")
 
-        for res in c.items():
-            try:
-                res_id = res[0]
-                if param_test is False:
+        # Look up DOIs and resource types once instead of per related resource
+        doi_by_rid = {rid: get_key_value(r, DOI_KEY) for rid, r in resources.items()}
+        type_by_rid = {rid: get_res_type_str(res_is_dataset) for rid, res_is_dataset in datasets.items()}
+
+        if param_test is False:
+            # The relation updates are independent of each other, so send them concurrently
+            with ThreadPoolExecutor(max_workers=DMS_MAX_WORKERS) as executor:
+                futures = {}
+                for res_id, relations in c.items():
                     if param_debug:
                         print("gen_pids/main: Update DMS for", res_id)
-                    dms_related(
-                        resources,
+                    future = executor.submit(
+                        dms_related,
+                        doi_by_rid,
+                        type_by_rid,
                         res_id,
-                        get_key_value(res[1], DMS_RELATION_TYPE_HASPART),
-                        get_key_value(res[1], DMS_RELATION_TYPE_ISPARTOF),
-                        get_key_value(res[1], DMS_RELATION_TYPE_OBSOLETES),
-                        get_key_value(res[1], DMS_RELATION_TYPE_ISOBSOLETEDBY),
+                        sorted(relations.get(DMS_RELATION_TYPE_HASPART, ())),
+                        sorted(relations.get(DMS_RELATION_TYPE_ISPARTOF, ())),
+                        sorted(relations.get(DMS_RELATION_TYPE_OBSOLETES, ())),
+                        sorted(relations.get(DMS_RELATION_TYPE_ISOBSOLETEDBY, ())),
                         param_debug,
-                )
-            except Exception:  # noqa: PERF203
-                print("gen_pids/main: Error when updating DMS for", res_id, file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
+                    )
+                    futures[future] = res_id
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception:  # noqa: PERF203
+                        print("gen_pids/main: Error when updating DMS for", futures[future], file=sys.stderr)
+                        print(traceback.format_exc(), file=sys.stderr)
 
 
 def dms_new(res_id: str, res: dict, res_is_dataset: bool, param_debug: bool, param_test: bool) -> str:
@@ -308,8 +324,8 @@ def dms_new(res_id: str, res: dict, res_is_dataset: bool, param_debug: bool, par
 
     if not param_test:
         # Register resource
-        response = requests.post(
-            DMS_URL, json=data_json, headers=DMS_HEADERS, auth=HTTPBasicAuth(DMS_AUTH_USER, DMS_AUTH_PASSWORD)
+        response = DMS_SESSION.post(
+            DMS_URL, json=data_json, headers=DMS_HEADERS, auth=DMS_AUTH
         )
 
         if param_debug:
@@ -319,7 +335,7 @@ def dms_new(res_id: str, res: dict, res_is_dataset: bool, param_debug: bool, par
         doi = ""
 
         if response.status_code == RESPONSE_CREATED:
-            d = response.json()
+            d = orjson.loads(response.content)
             if "data" in d:
                 data = d["data"]
                 if type(data) is list:
@@ -337,9 +353,20 @@ def dms_new(res_id: str, res: dict, res_is_dataset: bool, param_debug: bool, par
         return ""
 
 
-def dms_update(res_id: str, res: dict, res_is_dataset: bool, param_debug: bool, param_test: bool) -> bool:
+def dms_update(
+    res_id: str,
+    res: dict,
+    res_is_dataset: bool,
+    param_debug: bool,
+    param_test: bool,
+    dms_dates: Optional[dict] = None,
+) -> bool:
     """Update existing DMS metadata.
 
+    Arguments:
+        dms_dates {dict} -- "Created" and "Updated" dates of already fetched DMS records, by lower case DOI.
+            The dates are fetched from Datacite if the DOI is missing.
+
     Returns:
         bool -- If metadata was updated.
     """
@@ -347,7 +374,10 @@ def dms_update(res_id: str, res: dict, res_is_dataset: bool, param_debug: bool,
 
     doi = get_key_value(res, DOI_KEY)
     yaml_created, yaml_updated = get_res_dates(res)
-    dms_created, dms_updated = dms_doi_get_updated(doi, param_debug)
+    if dms_dates and doi.lower() in dms_dates:
+        dms_created, dms_updated = dms_dates[doi.lower()]
+    else:
+        dms_created, dms_updated = dms_doi_get_updated(doi, param_debug)
 
     # only update DataCite record if it is older than YAML record
     if dms_updated < yaml_updated or yaml_updated == "":
@@ -367,9 +397,9 @@ def dms_update(res_id: str, res: dict, res_is_dataset: bool, param_debug: bool,
 
         if not param_test:
             # Update resource
-            url = DMS_URL + "/" + doi
-            response = requests.put(
-                url, json=data_json, headers=DMS_HEADERS, auth=HTTPBasicAuth(DMS_AUTH_USER, DMS_AUTH_PASSWORD)
+            url = f"{DMS_URL}/{doi}"
+            response = DMS_SESSION.put(
+                url, json=data_json, headers=DMS_HEADERS, auth=DMS_AUTH
             )
 
             if param_debug:
@@ -392,36 +422,21 @@ def dms_create_json(res_id: str, res: dict, res_is_dataset: bool, dms_created, d
 
     # M - Mandatory. R - recommended. O - optional.
     # 1 - 1 value allowed. n - multiple values allowed.
-    dms_json = {
-        "data": {
-            "type": "dois",
-            "attributes": {
-                # DOI target
-                "url": dms_target,
-            },
-        }
-    }
 
     # 2. Mn. Creator
     dms_creators = get_res_creators(res)
-    dms_json["data"]["attributes"]["creators"] = dms_creators
 
     # 3. Mn. Title
-    dms_json["data"]["attributes"]["titles"] = []
+    titles = []
     value = get_key_value(res, "name", "swe")
     if value:
-        dms_json["data"]["attributes"]["titles"].append({"lang": DMS_LANG_SWE, "title": value})
+        titles.append({"lang": DMS_LANG_SWE, "title": value})
     value = get_key_value(res, "name", "eng")
     if value:
-        dms_json["data"]["attributes"]["titles"].append({"lang": DMS_LANG_ENG, "title": value})
+        titles.append({"lang": DMS_LANG_ENG, "title": value})
 
     # 4. M1. Publisher
-    dms_json["data"]["attributes"]["publisher"] = {
-        "name": DMS_CREATOR_NAME,
-        "publisherIdentifier": DMS_CREATOR_ROR,
-        "publisherIdentifierScheme": "ROR",
-        "schemeURI": "https://ror.org/",
-    }
+    # Set from DMS_PUBLISHER in the attributes dict below
 
     # 5. M1. Publication date
     # Datacite Publication Year is year of Created, else current year (https://github.com/spraakbanken/metadata-api/issues/21)
@@ -429,59 +444,38 @@ def dms_create_json(res_id: str, res: dict, res_is_dataset: bool, dms_created, d
         publication_year = dms_created[:4]
     else:
         publication_year = datetime.date.today().strftime("%Y")
-    dms_json["data"]["attributes"]["publicationYear"] = publication_year
 
     # 6. Rn. Subject
-    dms_json["data"]["attributes"]["subjects"] = [
-        {
-            "subject": "Language Technology (Computational Linguistics)",
-            "subjectScheme": "Standard för svensk indelning av forskningsämnen 2011",
-            "classificationCode": "10208",
-            "schemeURI": "https://www.scb.se/dokumentation/klassifikationer-och-standarder/standard-for-svensk-indelning-av-forskningsamnen",
-        }
-    ]
-    # add keywords
-    keywords = get_res_keywords(res)
-    if keywords:
-        for keyword in keywords:
-            dms_json["data"]["attributes"]["subjects"].append(keyword)
+    # research subject and keywords
+    subjects = [DMS_SUBJECT, *get_res_keywords(res)]
 
     # 7. Rn. Contributor
     # Skip
 
     # 8. Rn. Dates
-    if dms_created or dms_updated:
-        dms_json["data"]["attributes"]["dates"] = []
+    dates = []
     if dms_created:
-        dms_json["data"]["attributes"]["dates"].append({"date": dms_created, "dateType": "Created"})
+        dates.append({"date": dms_created, "dateType": "Created"})
     if dms_updated:
-        dms_json["data"]["attributes"]["dates"].append({"date": dms_updated, "dateType": "Updated"})
+        dates.append({"date": dms_updated, "dateType": "Updated"})
 
     # 9. O1. Primary language
-    dms_json["data"]["attributes"]["language"] = get_res_lang_code(get_key_value(res, "language_codes"))
+    language = get_res_lang_code(get_key_value(res, "language_codes"))
 
     # 10. M1. Resource type, Type/TypeGeneral forms a pair
     dms_resource_type = get_key_value(res, "type")
-    if res_is_dataset:
+    if get_key_value(res, "collection") is True:
+        dms_resource_type_general = DMS_RESOURCE_TYPE_COLLECTION
+    elif res_is_dataset:
         # dataset: corpus, lexicon, ...
-        if get_key_value(res, "collection") is True:
-            dms_resource_type_general = DMS_RESOURCE_TYPE_COLLECTION
-        else:
-            dms_resource_type_general = DMS_RESOURCE_TYPE_DATASET
+        dms_resource_type_general = DMS_RESOURCE_TYPE_DATASET
     else:
         # analysis/utility
-        if get_key_value(res, "collection") is True:
-            dms_resource_type_general = DMS_RESOURCE_TYPE_COLLECTION
-        else:
-            dms_resource_type_general = DMS_RESOURCE_TYPE_ANALYSIS
-    dms_json["data"]["attributes"]["types"] = {
-        "resourceType": dms_resource_type,
-        "resourceTypeGeneral": dms_resource_type_general
-    }
+        dms_resource_type_general = DMS_RESOURCE_TYPE_ANALYSIS
 
     # 11. On. Alternate identifier
     # resource ID (which is unique within Språkbanken Text)
-    dms_json["data"]["attributes"]["alternateIdentifiers"] = [
+    alternate_identifiers = [
         {
             "alternateIdentifierType": DMS_SLUG,
             "alternateIdentifier": res_id
@@ -492,21 +486,16 @@ def dms_create_json(res_id: str, res: dict, res_is_dataset: bool, dms_created, d
     # Set later for collections, successors
 
     # 13. On. Size
-    if res_is_dataset:
-        value = get_res_size(get_key_value(res, "size"))
-        if value:
-            dms_json["data"]["attributes"]["size"] = value
+    size = get_res_size(get_key_value(res, "size")) if res_is_dataset else ""
 
     # 14. On. Formatres_id
     # Skip
 
     # 16. On. Rights
-    value = get_key_value(res, "downloads")
-    if value:
-        dms_json["data"]["attributes"]["rightsList"] = get_res_rights(value)
+    downloads = get_key_value(res, "downloads")
 
     # 17. Rn. Descriptions
-    dms_json["data"]["attributes"]["descriptions"] = []
+    descriptions = []
     value_swe = get_key_value(res, "description", "swe")
     value_eng = get_key_value(res, "description", "eng")
     # swedish
@@ -522,7 +511,7 @@ def dms_create_json(res_id: str, res: dict, res_is_dataset: bool, dms_created, d
         if not res_is_dataset:
             value = get_key_value(res, "example")
             dms_description += "\n" + DMS_TITLE_EXAMPLE_SWE + "\n" + get_clean_string(value)
-        dms_json["data"]["attributes"]["descriptions"].append(
+        descriptions.append(
             {
                 "lang": DMS_LANG_SWE,
                 "description": dms_description.strip(),
@@ -539,7 +528,7 @@ def dms_create_json(res_id: str, res: dict, res_is_dataset: bool, dms_created, d
         if not res_is_dataset:
             value = get_key_value(res, "example")
             dms_description += "\n" + DMS_TITLE_EXAMPLE_ENG + "\n" + get_clean_string(value)
-        dms_json["data"]["attributes"]["descriptions"].append(
+        descriptions.append(
             {
                 "lang": DMS_LANG_ENG,
                 "description": dms_description.strip(),
@@ -556,11 +545,36 @@ def dms_create_json(res_id: str, res: dict, res_is_dataset: bool, dms_created, d
     # 20. On. Related items that don't have an ID/DOI
     # Skip
 
-    return dms_json
+    attributes = {
+        # DOI target
+        "url": dms_target,
+        "creators": dms_creators,
+        "titles": titles,
+        "publisher": DMS_PUBLISHER,
+        "publicationYear": publication_year,
+        "subjects": subjects,
+        "language": language,
+        "types": {
+            "resourceType": dms_resource_type,
+            "resourceTypeGeneral": dms_resource_type_general,
+        },
+        "alternateIdentifiers": alternate_identifiers,
+        "descriptions": descriptions,
+    }
+    # Optional fields are only sent if they have a value
+    if dates:
+        attributes["dates"] = dates
+    if size:
+        attributes["sizes"] = [size]
+    if downloads:
+        attributes["rightsList"] = get_res_rights(downloads)
+
+    return {"data": {"type": "dois", "attributes": attributes}}
 
 
 def dms_related(
-    resources: dict,
+    doi_by_rid: dict,
+    type_by_rid: dict,
     rid: str,
     has_part: list,
     is_part_of: list,
@@ -571,6 +585,8 @@ def dms_related(
     """Set related identifiers for resource, both collections and members.
 
     Arguments:
+        doi_by_rid {dict} -- DOI for every resource ID ("" if the resource has no DOI).
+        type_by_rid {dict} -- resourceTypeGeneral string for every resource ID.
         rid {str} -- ID of resource.
         has_part {list} -- list of resources (resource IDs) that the entity is collection for (HasPart).
         is_part_of {list} -- list of resources (resource IDs) that the entity is a member of (IsPartOf).
@@ -581,24 +597,24 @@ def dms_related(
         bool -- Success.
     """
     # Get DOI of resource with related other resources
-    res_doi = get_doi_from_rid(resources, rid)
+    res_doi = doi_by_rid.get(rid, "")
     if (res_doi != ""):
         # Build list of relatedIdentifiers (HasPart)
         result = []
         for related_rid in has_part:
-            doi = get_doi_from_rid(resources, related_rid)
+            doi = doi_by_rid.get(related_rid, "")
             if (doi != ""):
                 result.append(
                     {
                         "relatedIdentifierType": "DOI",
                         "relationType": DMS_RELATION_TYPE_HASPART,
-                        "resourceTypeGeneral": get_res_type_str(is_dataset(resources[related_rid])),
+                        "resourceTypeGeneral": type_by_rid[related_rid],
                         "relatedIdentifier": doi,
                     }
                 )
         # Build list of relatedIdentifiers (IsPartOf)
         for related_rid in is_part_of:
-            doi = get_doi_from_rid(resources, related_rid)
+            doi = doi_by_rid.get(related_rid, "")
             if (doi != ""):
                 result.append(
                     {
@@ -610,25 +626,25 @@ def dms_related(
                 )
         # Build list of relatedIdentifiers (Obsoletes)
         for related_rid in obsoletes:
-            doi = get_doi_from_rid(resources, related_rid)
+            doi = doi_by_rid.get(related_rid, "")
             if (doi != ""):
                 result.append(
                     {
                         "relatedIdentifierType": "DOI",
                         "relationType": DMS_RELATION_TYPE_OBSOLETES,
-                        "resourceTypeGeneral": get_res_type_str(is_dataset(resources[related_rid])),
+                        "resourceTypeGeneral": type_by_rid[related_rid],
                         "relatedIdentifier": doi,
                     }
                 )
         # Build list of relatedIdentifiers (IsObsoletedBy)
         for related_rid in is_obsoleted_by:
-            doi = get_doi_from_rid(resources, related_rid)
+            doi = doi_by_rid.get(related_rid, "")
             if (doi != ""):
                 result.append(
                     {
                         "relatedIdentifierType": "DOI",
                         "relationType": DMS_RELATION_TYPE_ISOBSOLETEDBY,
-                        "resourceTypeGeneral": get_res_type_str(is_dataset(resources[related_rid])),
+                        "resourceTypeGeneral": type_by_rid[related_rid],
                         "relatedIdentifier": doi,
                     }
                 )
@@ -644,9 +660,9 @@ def dms_related(
             print("gen_pids/dms_related: Set related identifiers for", rid)
 
         # Update resource
-        url = DMS_URL + "/" + res_doi
-        response = requests.put(
-            url, json=data_json, headers=DMS_HEADERS, auth=HTTPBasicAuth(DMS_AUTH_USER, DMS_AUTH_PASSWORD)
+        url = f"{DMS_URL}/{res_doi}"
+        response = DMS_SESSION.put(
+            url, json=data_json, headers=DMS_HEADERS, auth=DMS_AUTH
         )
 
         if param_debug:
@@ -661,6 +677,40 @@ def dms_related(
         return False
 
 
+def dms_doi_list(param_debug: bool) -> Optional[list]:
+    """Get all DMS records in Språkbanken Text's Datacite repository.
+
+    The records are fetched in pages, following the "next" links of the responses.
+
+    Returns:
+        list -- DMS records (the "data" items) or None if the records could not be fetched.
+    """
+    records = []
+    url = DMS_URL
+    params = {"client-id": DMS_REPOID, "page[size]": DMS_PAGE_SIZE, "page[cursor]": 1}
+
+    try:
+        while url:
+            response = DMS_SESSION.get(url=url, params=params)
+            if response.status_code != RESPONSE_OK:
+                print("gen_pids/dms_doi_list: Error getting DOIs", response.status_code, file=sys.stderr)
+                return None
+            d = orjson.loads(response.content)
+            data = d.get("data", [])
+            records.extend(data)
+            # The "next" link already contains all query parameters
+            url = d.get("links", {}).get("next") if data else None
+            params = None
+    except Exception:
+        print("gen_pids/dms_doi_list: Error getting DOIs", file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+        return None
+
+    if param_debug:
+        print("gen_pids/dms_doi_list: Got", len(records), "DOIs")
+    return records
+
+
 def dms_doi_get(res_id: str, param_debug: bool) -> str:
     """Metadata.yaml could be autogenerated, so look up if existing at DC.
 
@@ -676,27 +726,20 @@ def dms_doi_get(res_id: str, param_debug: bool) -> str:
         str -- DOI or "" if rid not found.
     """
     search_url = (
-        DMS_URL
-        + "?client-id="
-        + DMS_REPOID
-        + "&"
-        + "query=identifiers.identifier:"
-        + res_id
-        + "%20AND%20identifiers.identifierType:"
-        + DMS_SLUG
-        + "&detail=true"
+        f"{DMS_URL}?client-id={DMS_REPOID}&query=identifiers.identifier:{res_id}"
+        f"%20AND%20identifiers.identifierType:{DMS_SLUG}&detail=true"
     )
 
     doi = ""
 
-    response = requests.get(
+    response = DMS_SESSION.get(
         url=search_url,
     )
 
     if param_debug:
         print("gen_pids/dms_doi_get: Get DOI from res id", res_id)
     if response.status_code == RESPONSE_OK:
-        d = response.json()
+        d = orjson.loads(response.content)
         if "data" in d:
             data = d["data"]
             if type(data) is list:
@@ -730,35 +773,33 @@ def dms_doi_get_updated(doi: str, param_debug: bool) -> tuple[str, str]:
         str -- date for updated value (eg "dates" : [{"date": "2024-06-18", "dateType": "Updated"}])
 
     """
-    search_url = DMS_URL + "/" + doi
+    search_url = f"{DMS_URL}/{doi}"
     # "&detail=true"
 
     dms_updated = ""
     dms_created = ""
 
-    response = requests.get(
+    response = DMS_SESSION.get(
         url=search_url,
     )
 
     if param_debug:
         print("gen_pids/dms_doi_get_updated: Get updated ", doi)
     if response.status_code == RESPONSE_OK:
-        d = response.json()
+        d = orjson.loads(response.content)
         if "data" in d:
-            data = d["data"]
-            if "attributes" in data:
-                attributes = data["attributes"]
-                if "dates" in attributes:
-                    dates = attributes["dates"]
-                    for x in dates:
-                        if x["dateType"] == "Updated":
-                            dms_updated = x["date"]
-                        elif x["dateType"] == "Created":
-                            dms_created = x["date"]
+            dms_created, dms_updated = get_dms_dates(d["data"])
 
     return dms_created, dms_updated
 
 
+def get_dms_dates(record: dict) -> tuple[str, str]:
+    """Get date "Created" and "Updated" from a DMS record (a "data" item), "" if missing."""
+    dates = (record.get("attributes") or {}).get("dates") or []
+    by_type = {x.get("dateType"): x.get("date", "") for x in dates}
+    return by_type.get("Created", ""), by_type.get("Updated", "")
+
+
 """
 Helper functions
 """
@@ -769,7 +810,7 @@ def is_dataset(resource: dict):
     (false if it is an analysis)
 
     """
-    return not (get_key_value(resource, "type") == "analysis" or get_key_value(resource, "type") == "utility")
+    return get_key_value(resource, "type") not in ("analysis", "utility")
 
 
 
@@ -781,6 +822,24 @@ def get_res_type_str(dataset: bool):
         return DMS_RESOURCE_TYPE_ANALYSIS
 
 
+def get_slug_dois(dms_records: list) -> dict:
+    """Map resource IDs (DMS "slug" identifiers) to DOIs."""
+    dois = {}
+    for record in dms_records:
+        doi = record.get("id")
+        if not doi:
+            continue
+        for identifier in (record.get("attributes") or {}).get("identifiers") or []:
+            if identifier.get("identifierType") == DMS_SLUG:
+                res_id = identifier.get("identifier")
+                if res_id in dois:
+                    # This should never happen, as res_id should be unique among Språkbanken Text
+                    print("gen_pids/get_slug_dois: Error, multiple DOIs for", res_id, file=sys.stderr)
+                    continue
+                dois[res_id] = doi
+    return dois
+
+
 def get_res_lang_code(language_list: list) -> str:
     """Translate code to ISO right version."""
     if language_list:
@@ -791,28 +850,16 @@ def get_res_lang_code(language_list: list) -> str:
     return ""
 
 
-def get_res_size(size_list: list) -> str:
+def get_res_size(size_dict: dict) -> str:
     """Create string of resource size info."""
-    result = ""
-    if type(size_list) is list:
-        for key, value in size_list.items():
-            if result:
-                result += ". " + key + ": " + value
-            else:
-                result = key + ": " + value
-    return result
+    if not isinstance(size_dict, dict):
+        return ""
+    return ". ".join(f"{key}: {value}" for key, value in size_dict.items())
 
 
 def get_res_format(downloads_list: list) -> str:
-    """Create string of download URLs."""
-    result = ""
-    for key, value in downloads_list.items():
-        if key == "format":
-            if result:
-                result += ", " + value
-            else:
-                result = value
-    return result
+    """Create string of download formats."""
+    return ", ".join(d["format"] for d in downloads_list or [] if d.get("format"))
 
 
 def get_res_license(download_item: dict) -> dict:
@@ -836,18 +883,9 @@ def get_res_rights(downloads_list: list) -> dict:
     Returns:
         rightsList item (or empty dict)
     """
-    result = []
-    result_set = set()
-    for item in downloads_list:
-        rights = item.get("licence", "")
-        if rights:
-            result_set.add(rights)
-    for rights in result_set:
-        result.append({
-            "rights": rights
-        })
-
-    return result
+    # dict.fromkeys() removes duplicates but keeps the order, so the result is the same in every run
+    licences = dict.fromkeys(item["licence"] for item in downloads_list if item.get("licence"))
+    return [{"rights": rights} for rights in licences]
 
 
 def get_res_creators(res: str) -> list:
@@ -889,77 +927,71 @@ def get_res_keywords(res: dict) -> list:
 
 def get_res_dates(res: dict) -> tuple[str, str]:
     """Return 'created' and 'updated' dates as strings and check that they are valid."""
-    created = get_key_value(res, "created")
-    if created:
-        if type(created) is str:
-            created_str = created
-        else:
-            # assume type is date
-            created_str = datetime.datetime.strftime(created, "%Y-%m-%d") if created else ""
-    else:
-        created_str = ""
+    return get_date_string(get_key_value(res, "created")), get_date_string(get_key_value(res, "updated"))
 
-    updated = get_key_value(res, "updated")
-    if updated:
-        if type(updated) is str:
-            updated_str = updated
-        else:
-            # assume type is date
-            updated_str = datetime.datetime.strftime(updated, "%Y-%m-%d") if updated else ""
-    else:
-        updated_str = ""
-    return created_str, updated_str
 
+def get_date_string(value) -> str:
+    """Return date (from YAML) as a YYYY-MM-DD string, strings are returned as is."""
+    if not value:
+        return ""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    # assume type is date
+    return value.isoformat()
 
-def get_clean_string(string: str) -> str:
-    """Remove HTML etc from string."""
 
-    #value = re.sub('<[^>]+>', '', value) # remove HTML tags
-    #value = re.sub(r'\n\s*\n', '\n\n', value) # remove multiple newlines
-    #return re.sub(r"<.*?>", "", string)
+@lru_cache(maxsize=4096)
+def get_clean_string(string: str) -> str:
+    """Remove Markdown, HTML etc from string.
 
+    Cached, as the same descriptions and examples are cleaned several times.
+    """
     # handle beginning-of-code quotes, eg ```xml
-    md = re.sub(r'(^\s*```)[^\s`]+\n', r'\1' , string, flags=re.MULTILINE)
+    md = MD_FENCE_LANG_RE.sub(r"\1", string)
     # transform from markdown to HTML
-    html = markdown.markdown(md)
+    md_html = MARKDOWN.reset().convert(md)
     # let BS export clean text
-    soup = BeautifulSoup(html, "html.parser")
+    soup = BeautifulSoup(md_html, "html.parser")
     text = soup.get_text()
     # remove multiple newlines
-    text = re.sub(r'\n\s*\n', '\n\n', text)
+    text = BLANK_LINES_RE.sub("\n\n", text)
 
     return text
 
 
-def get_key_value(dictionary: dict, key: str, key2: Optional[str] = None) -> any:
-    """Return key value from dictionary, else empty string."""
-    if key2 is None:
-        value = dictionary.get(key, "")
-        return value or ""
-    if key in dictionary:
-        value = get_key_value(dictionary[key], key2)
-        return value or ""
-    return ""
+def add_yaml_line(filepath: str, line: str) -> None:
+    """Append line to YAML file, making sure it starts on a new line."""
+    with open(filepath, mode="rb+") as file_yaml:
+        # Only the last byte is needed to find out if the file ends with a newline
+        if file_yaml.seek(0, os.SEEK_END) > 0:
+            file_yaml.seek(-1, os.SEEK_END)
+            if file_yaml.read(1) != b"\n":
+                line = "\n" + line
+        file_yaml.seek(0, os.SEEK_END)
+        file_yaml.write(f"{line}\n".encode("utf-8"))
 
 
-def get_key_list_value(dictionary: dict, key: str) -> list:
-    """Return key value from dictionary, else empty list, []."""
-    return dictionary.get(key, [])
+def iter_yaml(root: Path) -> Iterator[tuple[str, str]]:
+    """Yield (resource ID, file path) for all YAML files in root and its subdirs."""
+    for dirpath, _dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(".yaml"):
+                yield filename[:-5], os.path.join(dirpath, filename)
 
 
-def get_doi_from_rid(res: dict, rid: str) -> str:  # noqa: D417
-    """Return DOI belonging to a resource ID.
+def get_key_value(dictionary: dict, key: str, key2: Optional[str] = None) -> any:
+    """Return key value from dictionary, else empty string."""
+    value = dictionary.get(key)
+    if key2 is not None:
+        value = value.get(key2) if isinstance(value, dict) else None
+    return value or ""
 
-    Arguments:
-        res {dict} -- Resources
-        rid {str} -- resource ID
 
-    Returns:
-        str -- DOI or "" if rid not found.
-    """
-    if rid in res and "doi" in res[rid]:
-        return res[rid]["doi"]
-    return ""
+def get_key_list_value(dictionary: dict, key: str) -> list:
+    """Return key value from dictionary, else empty list, []."""
+    return dictionary.get(key) or []
 
 
 
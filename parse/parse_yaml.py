@@ -4,20 +4,58 @@
 
 import argparse
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import datetime
+from email.utils import parsedate_to_datetime
+from functools import partial
+import hashlib
 import json
+import os
 from pathlib import Path
 import sys
+import time
+from urllib.parse import urlsplit
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import yaml
 from translate_lang import get_lang_names
 import jsonschema
-from gen_pids import is_dataset
+from gen_pids import YAML_LOADER, is_dataset, iter_yaml
 
 STATIC_DIR = Path("../metadata_api/static")
 YAML_DIR = Path("../metadata/yaml")
 SCHEMA_DIR = Path("../metadata/schema")
+CACHE_DIR = Path("cache")  # Kept out of STATIC_DIR, which is served by the API
 OUT_RESOURCE_TEXTS = STATIC_DIR / "resource-texts.json"
+HEAD_CACHE = CACHE_DIR / "head-cache.json"  # File info and cache validators for downloadables from earlier runs
+VALIDATE_CACHE = CACHE_DIR / "validate-cache.json"  # Hashes of the YAML files that passed validation in earlier runs
+HEAD_MAX_WORKERS = 32  # Max number of concurrent HEAD requests for downloadables
+HEAD_TIMEOUT = (3, 10)  # Connect and read timeout in seconds
+HEAD_RETRIES = Retry(total=2, backoff_factor=0.2)  # Retry HEAD requests that fail on connection errors
+HEAD_CACHE_TTL = 24 * 60 * 60  # Seconds before cached file info is checked against the server again
+WRITE_MAX_WORKERS = 4  # Max number of JSON output files written at the same time
+YAML_CHUNKSIZE = 16  # Number of YAML files sent to a worker process at a time
+# Set in each worker process by init_yaml_worker
+RESOURCE_VALIDATOR = None  # Schema validator
+SCHEMA_HASH = b""  # Hash of the schema (and the schema files it references), part of the file hashes in the validate cache
+VALID_HASHES = {}  # Validate cache from the last run
+
+
+class DateStringLoader(YAML_LOADER):
+    """YAML safe loader that handles dates as strings (as expected by the schema)."""
+
+
+DateStringLoader.add_constructor("tag:yaml.org,2002:timestamp", DateStringLoader.yaml_constructors["tag:yaml.org,2002:str"])
+
+# Shared session, so that connections to the download servers are kept alive and reused
+SESSION = requests.Session()
+for prefix in ("http://", "https://"):
+    SESSION.mount(
+        prefix,
+        HTTPAdapter(pool_connections=HEAD_MAX_WORKERS, pool_maxsize=HEAD_MAX_WORKERS, max_retries=HEAD_RETRIES),
+    )
 
 # Instatiate command line arg parser
 parser = argparse.ArgumentParser(description="Read YAML metadata files, compile and prepare information for the API")
@@ -33,71 +71,174 @@ def main(resource_types=None, debug=False, offline=False, validate=False):
     resource_ids = []
     all_resources = {}
     resource_texts = defaultdict(dict)
-    collection_mappings = {}
-
-    if validate:
-        resource_schema = get_schema(SCHEMA_DIR / "metadata.json")
-        # YAML safe_load() - handle dates as strings
-        yaml.constructor.SafeConstructor.yaml_constructors["tag:yaml.org,2002:timestamp"] = (
-            yaml.constructor.SafeConstructor.yaml_constructors["tag:yaml.org,2002:str"]
+    collection_mappings = defaultdict(set)
+
+    resource_schema = get_schema(SCHEMA_DIR / "metadata.json") if validate else None
+    schema_hash = get_schema_hash(resource_schema, SCHEMA_DIR) if resource_schema is not None else None
+    valid_hashes = read_json(VALIDATE_CACHE) if schema_hash is not None else {}
+    new_valid_hashes = {}
+
+    # The YAML files are independent of each other, so they are parsed (and validated) in parallel processes
+    # Sort by resource ID (file name), so that all_resources is filled in alphabetical order
+    filepaths = [Path(filepath) for _, filepath in sorted(iter_yaml(YAML_DIR))]
+    if debug:
+        print(f"Using YAML loader {YAML_LOADER.__name__}")
+    with ProcessPoolExecutor(initializer=init_yaml_worker, initargs=(resource_schema, schema_hash, valid_hashes)) as executor:
+        results = executor.map(
+            partial(get_yaml, debug=debug, validate=validate),
+            filepaths,
+            chunksize=YAML_CHUNKSIZE,
         )
-    else:
-        resource_schema = None
-
-    for filepath in sorted(YAML_DIR.glob("**/*.yaml")):
-        # Get resources from yaml
-        yaml_resources = get_yaml(filepath, resource_texts, collection_mappings, resource_schema, debug=debug, offline=offline, validate=validate)
-        # Get resource-text-mapping
-        resource_ids.extend(list(yaml_resources.keys()))
-        # Save result in all_resources
-        all_resources.update(yaml_resources)
-
-    # Sort alphabetically by key
-    all_resources = dict(sorted(all_resources.items()))
+        for yaml_resources, yaml_texts, yaml_collections, yaml_valid_hashes in results:
+            # Get resource-text-mapping
+            resource_ids.extend(list(yaml_resources.keys()))
+            # Save result in all_resources
+            all_resources.update(yaml_resources)
+            for fileid, texts in yaml_texts.items():
+                resource_texts[fileid].update(texts)
+            for collection_id, members in yaml_collections.items():
+                collection_mappings[collection_id].update(members)
+            new_valid_hashes.update(yaml_valid_hashes)
+
+    if schema_hash is not None:
+        write_json(VALIDATE_CACHE, new_valid_hashes)
+
+    if not offline:
+        # Add file info for downloadables, revalidating the file info cached by earlier runs
+        head_cache = add_download_metadata(all_resources, read_json(HEAD_CACHE))
+        write_json(HEAD_CACHE, head_cache)
+
+    # Split resources by type and pick out the collections in a single pass
+    res_json_by_type = {resource_type: {} for resource_type in resource_types}
+    collection_json = {}
+    for res_id, res in all_resources.items():
+        res_json = res_json_by_type.get(res.get("type", ""))
+        if res_json is not None:
+            res_json[res_id] = res
+        if res.get("collection"):
+            collection_json[res_id] = res
 
     # Add sizes and resource-lists to collections
-    collection_json = {k: v for k, v in all_resources.items() if v.get("collection")}
     update_collections(collection_mappings, collection_json, all_resources)
 
-    # Dump resource texts as json
-    write_json(OUT_RESOURCE_TEXTS, resource_texts)
-
-    # Set has_description for every resource and save as json
-    for resource_type in resource_types:
-        res_json = {k: v for k, v in all_resources.items() if v.get("type", "") == resource_type}
+    # Set has_description for every resource
+    for res_json in res_json_by_type.values():
         set_description_bool(res_json, resource_texts)
-        write_json(STATIC_DIR / f"{resource_type}.json", res_json)
-    write_json(STATIC_DIR / "collection.json", collection_json)
+
+    # Dump resource texts, resources and collections as json. The files are independent, so they are written
+    # concurrently (most of the time is spent waiting for fsync, which releases the GIL).
+    outputs = {STATIC_DIR / f"{resource_type}.json": res_json for resource_type, res_json in res_json_by_type.items()}
+    outputs[STATIC_DIR / "collection.json"] = collection_json
+    outputs[OUT_RESOURCE_TEXTS] = resource_texts
+    with ThreadPoolExecutor(max_workers=WRITE_MAX_WORKERS) as executor:
+        for future in [executor.submit(write_json, path, data) for path, data in outputs.items()]:
+            future.result()
 
 
 def get_schema(filepath):
     try:
        with open(filepath) as schema_file:
             schema = json.load(schema_file)
+       # Check the schema itself once here instead of for every validated resource
+       jsonschema.validators.validator_for(schema).check_schema(schema)
     except Exception:
         print(f"Error: failed to get schema '{filepath}'")
         schema = None
 
     return schema
 
-def get_yaml(filepath, resource_texts, collections, resource_schema, debug=False, offline=False, validate=False):
-    """Gather all yaml resource files of one type, update resource texts and collections dict."""
+
+def get_schema_hash(schema, schema_dir):
+    """Hash the schema together with the local schema files it references with $ref (recursively).
+
+    A changed hash invalidates all cached validation results. Relative references are resolved against the directory
+    of the referencing file. If the schema references anything else (e.g. a URL) or a referenced file is missing,
+    changes cannot be detected and None is returned, meaning that the validate cache is not used.
+    """
+    schema_hash = hashlib.sha256(orjson.dumps(schema, option=orjson.OPT_SORT_KEYS))
+    seen = set()
+    pending = [(schema, Path(schema_dir))]
+    while pending:
+        node, base_dir = pending.pop()
+        for ref in iter_refs(node):
+            ref_file = ref.partition("#")[0]
+            if not ref_file:
+                continue  # Reference within the same file
+            if urlsplit(ref_file).scheme:
+                print(f"Schema references '{ref}', not using the validate cache")
+                return None
+            ref_path = (base_dir / ref_file).resolve()
+            if ref_path in seen:
+                continue
+            seen.add(ref_path)
+            try:
+                data = ref_path.read_bytes()
+                pending.append((json.loads(data), ref_path.parent))
+            except (OSError, ValueError):
+                print(f"Schema references '{ref}' which could not be read, not using the validate cache")
+                return None
+            schema_hash.update(data)
+
+    return schema_hash.digest()
+
+
+def iter_refs(node):
+    """Yield all $ref values in a (sub)schema."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "$ref" and isinstance(value, str):
+                yield value
+            else:
+                yield from iter_refs(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from iter_refs(item)
+
+
+def init_yaml_worker(resource_schema=None, schema_hash=None, valid_hashes=None):
+    """Prepare a worker process for get_yaml."""
+    global RESOURCE_VALIDATOR, SCHEMA_HASH, VALID_HASHES  # noqa: PLW0603
+    if resource_schema is not None:
+        # Compile the validator once per worker, jsonschema.validate() would do it for every resource
+        RESOURCE_VALIDATOR = jsonschema.validators.validator_for(resource_schema)(resource_schema)
+    if schema_hash is not None:
+        SCHEMA_HASH = schema_hash
+        VALID_HASHES = valid_hashes or {}
+
+
+def get_yaml(filepath, debug=False, validate=False):
+    """Read a yaml resource file, return its resources, resource texts, collections dict (of sets) and validate cache.
+
+    Runs in a worker process, so nothing is shared with the caller except the return value.
+    Files that passed validation with the same schema in an earlier run (same hash) are not validated again.
+    """
     resources = {}
+    resource_texts = defaultdict(dict)
+    collections = defaultdict(set)
+    valid_hashes = {}
     add_resource = True
 
     try:
         if debug:
             print(f"  Processing {filepath}")
-        with filepath.open(encoding="utf-8") as f:
-            res = yaml.safe_load(f)
+        with filepath.open("rb") as f:
+            data = f.read()
+            # Handle dates as strings when validating
+            res = yaml.load(data, Loader=DateStringLoader if validate else YAML_LOADER)  # noqa: S506
             fileid = filepath.stem
 
             if validate:
                 # validate YAML if it is a corpus etc (not analyses yet, https://github.com/spraakbanken/metadata/issues/7)
                 if is_dataset(res):
-                    if resource_schema is not None:
+                    if RESOURCE_VALIDATOR is not None:
+                        file_hash = hashlib.sha256(SCHEMA_HASH + data).hexdigest()
                         try:
-                            jsonschema.validate(instance=res, schema=resource_schema)
+                            if VALID_HASHES.get(fileid) != file_hash:
+                                # Report the same error as jsonschema.validate(), not just the first one found
+                                error = jsonschema.exceptions.best_match(RESOURCE_VALIDATOR.iter_errors(res))
+                                if error is not None:
+                                    raise error
+                            valid_hashes[fileid] = file_hash
                         except jsonschema.exceptions.ValidationError as e:
                             print(f"Error: validation error for {fileid}: {e.message}", file=sys.stderr)
                             add_resource = False
@@ -108,121 +249,177 @@ def get_yaml(filepath, resource_texts, collections, resource_schema, debug=False
             if add_resource:
                 new_res = {"id": fileid}
                 # Make sure size attrs only contain numbers
-                for k, v in res.get("size", {}).items():
-                    if not str(v).isdigit():
-                        res["size"][k] = 0
+                size = res.get("size")
+                if size:
+                    for k, v in size.items():
+                        if not str(v).isdigit():
+                            size[k] = 0
 
                 # Update resouce_texts and remove long_descriptions for now
-                if res.get("description", {}).get("swe", "").strip():
-                    resource_texts[fileid]["swe"] = res["description"]["swe"]
-                if res.get("description", {}).get("eng", "").strip():
-                    resource_texts[fileid]["eng"] = res["description"]["eng"]
-                res.pop("description", None)
+                description = res.pop("description", None) or {}
+                for lang in ("swe", "eng"):
+                    text = description.get(lang) or ""
+                    if text.strip():
+                        resource_texts[fileid][lang] = text
 
                 # Get full language info
-                langs = res.get("languages", [])
-                for langcode in res.get("language_codes", []):
-                    if langcode not in [l.get("code") for l in langs]:
+                langs = res.get("languages") or []
+                known_codes = {l.get("code") for l in langs}
+                for langcode in res.get("language_codes") or []:
+                    if langcode not in known_codes:
                         try:
                             english_name, swedish_name = get_lang_names(langcode)
                             langs.append({"code": langcode, "name": {"swe": swedish_name, "eng": english_name}})
+                            known_codes.add(langcode)
                         except LookupError:
                             print(f"Error: Could not find language code {langcode} (resource: {fileid})")
                 res["languages"] = langs
                 res.pop("language_codes", "")
 
-                if not offline:
-                    # Add file info for downloadables
-                    res_type = res.get("type")
-                    for d in res.get("downloads", []):
-                        url = d.get("url")
-                        if url and not ("size" in d and "last-modified" in d):
-                            size, date = get_download_metadata(url, fileid, res_type)
-                            d["size"] = size
-                            d["last-modified"] = date
-
                 new_res.update(res)
                 resources[fileid] = new_res
 
                 # Update collections dict
                 if res.get("collection") is True:
-                    collections[fileid] = collections.get(fileid, [])
-                    if res.get("resources"):
-                        collections[fileid].extend(res["resources"])
-                        collections[fileid] = sorted(set(collections[fileid]))
+                    collections[fileid].update(res.get("resources") or ())
 
-                if res.get("in_collections"):
-                    for collection_id in res["in_collections"]:
-                        collections[collection_id] = collections.get(collection_id, [])
-                        collections[collection_id].append(fileid)
-                        collections[collection_id] = sorted(set(collections[collection_id]))
+                for collection_id in res.get("in_collections") or ():
+                    collections[collection_id].add(fileid)
 
     except Exception:
         print(f"Error: failed to process '{filepath}'")
 
-    return resources
+    return resources, dict(resource_texts), dict(collections), valid_hashes
 
 
 def update_collections(collection_mappings, collection_json, all_resources):
-    """Add sizes and resource-lists to collections."""
+    """Add sizes and resource-lists to collections (collection_mappings holds sets of resource IDs)."""
+    # in_collections of each resource as a set, for fast membership checks (built when the resource is first needed)
+    in_collections_sets = {}
     for collection, res_list in collection_mappings.items():
         col = collection_json.get(collection)
         if not col:
             print(
                 f"ERROR: Collection '{collection}' is not defined but was referenced by the following resource: "
-                f"{', '.join(res_list)}. Removing collection from these resources."
+                f"{', '.join(sorted(res_list))}. Removing collection from these resources."
             )
             for res_id in res_list:
                 res = all_resources.get(res_id, {})
-                col_list = res.get("in_collections", [])
-                col_list.remove(collection)
-                if not col_list:
-                    res.pop("in_collections")
+                col_list = [c for c in res.get("in_collections", []) if c != collection]
+                if col_list:
+                    res["in_collections"] = col_list
+                else:
+                    res.pop("in_collections", None)
             continue
 
         # Remove resource IDs for non-existing resources
-        new_res_list = [i for i in res_list if i in all_resources]
+        new_res_list = sorted(res_list & all_resources.keys())
 
         col_id = col.get("id")
         if col:
-            col["size"] = col.get("size", {})
-            col["size"]["resources"] = len(new_res_list)
+            col.setdefault("size", {})["resources"] = len(new_res_list)
             col["resources"] = new_res_list
 
             # Add in_collections info to json of the collection's resources
             for res_id in new_res_list:
-                res_item = all_resources.get(res_id)
-                if res_item and col_id not in res_item.get("in_collections", []):
-                    res_item["in_collections"] = res_item.get("in_collections", [])
-                    res_item["in_collections"].append(col_id)
-
-
-def get_download_metadata(url, name, res_type):
-    """Check headers of file from url and return the file size and last modified date."""
+                res_item = all_resources[res_id]
+                known = in_collections_sets.get(res_id)
+                if known is None:
+                    known = in_collections_sets[res_id] = set(res_item.get("in_collections", ()))
+                if col_id not in known:
+                    res_item.setdefault("in_collections", []).append(col_id)
+                    known.add(col_id)
+
+
+def add_download_metadata(resources, head_cache):
+    """Add file size and last modified date to the downloadables of all resources.
+
+    The HEAD requests are I/O bound and independent of each other, so they are sent concurrently.
+    Return the new HEAD cache (file info by URL) for the next run.
+    """
+    new_head_cache = {}
+    # Downloads by URL, so that every URL is only requested once even if several resources share it
+    downloads = defaultdict(list)
+    for res_id, res in resources.items():
+        for d in res.get("downloads") or []:
+            url = d.get("url")
+            if url and not ("size" in d and "last-modified" in d):
+                downloads[url].append((d, res_id, res.get("type")))
+
+    def get_url_metadata(url):
+        _, res_id, res_type = downloads[url][0]
+        return get_download_metadata(url, res_id, res_type, head_cache.get(url))
+
+    with ThreadPoolExecutor(max_workers=HEAD_MAX_WORKERS) as executor:
+        for url, (size, date, cache_info) in zip(downloads, executor.map(get_url_metadata, downloads)):
+            for d, _, _ in downloads[url]:
+                d["size"] = size
+                d["last-modified"] = date
+            if cache_info:
+                new_head_cache[url] = {"size": size, "last-modified": date, **cache_info}
+
+    return new_head_cache
+
+
+def get_download_metadata(url, name, res_type, cached=None):
+    """Check headers of file from url and return the file size, last modified date and info for the HEAD cache.
+
+    Cached info from an earlier run is used as is if it was checked less than HEAD_CACHE_TTL seconds ago. Otherwise a
+    conditional request (ETag and/or Last-Modified) is sent and the cached values are returned if the file has not
+    changed. The cache info is empty if the result should not be cached.
+    """
+    now = time.time()
+    if cached and now - cached.get("checked", 0) < HEAD_CACHE_TTL:
+        cache_info = {k: cached[k] for k in ("etag", "http-last-modified", "checked") if cached.get(k)}
+        return cached["size"], cached["last-modified"], cache_info
+
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("http-last-modified"):
+            headers["If-Modified-Since"] = cached["http-last-modified"]
     try:
-        res = requests.head(url)
+        res = SESSION.head(url, headers=headers, allow_redirects=True, timeout=HEAD_TIMEOUT)
+        if headers and res.status_code == 304:  # noqa: PLR2004
+            cache_info = {k: cached[k] for k in ("etag", "http-last-modified") if cached.get(k)}
+            cache_info["checked"] = now
+            return cached["size"], cached["last-modified"], cache_info
         size = int(res.headers.get("Content-Length")) if res.headers.get("Content-Length") else None
-        date = res.headers.get("Last-Modified")
-        if date:
-            date = datetime.datetime.strptime(date, "%a, %d %b %Y %H:%M:%S %Z").strftime("%Y-%m-%d")
+        http_date = res.headers.get("Last-Modified")
+        date = None
+        if http_date:
+            date = parsedate_to_datetime(http_date).date().isoformat()
+        cache_info = {}
+        if res.ok:
+            cache_info["checked"] = now
+            if res.headers.get("ETag"):
+                cache_info["etag"] = res.headers["ETag"]
+            if http_date:
+                cache_info["http-last-modified"] = http_date
         if res.status_code == 404:  # noqa: PLR2004
             print(f"Error: Could not find downloadable for {res_type} '{name}': {url}")
     except Exception:
         print(f"Error: Could not get downloadable '{name}': {url}")
         # Set to some kind of neutral values
         size = 0
-        date = datetime.today().strftime("%Y-%m-%d")
-    return size, date
+        date = datetime.date.today().strftime("%Y-%m-%d")
+        cache_info = {}
+    return size, date, cache_info
 
 
 def set_description_bool(resources, resource_texts):
     """Add bool 'has_description' for every resource."""
-    for i in resources:
-        resources[i]["has_description"] = False
-        if resources[i].get("description"):
-            resources[i]["has_description"] = True
-        if resource_texts.get(i):
-            resources[i]["has_description"] = True
+    for res_id, res in resources.items():
+        res["has_description"] = bool(res.get("description") or resource_texts.get(res_id))
+
+
+def read_json(filename):
+    """Read json file, return an empty dict if it does not exist or cannot be read."""
+    try:
+        return orjson.loads(Path(filename).read_bytes())
+    except Exception:
+        return {}
 
 
 def write_json(filename, data):
@@ -230,9 +427,14 @@ def write_json(filename, data):
     outfile = Path(filename)
     outfile.parent.mkdir(parents=True, exist_ok=True)
     tmp_path = outfile.parent / (outfile.name + ".new")
-    with tmp_path.open("w") as f:
-        json.dump(data, f, default=str)
-    tmp_path.rename(filename)
+    with tmp_path.open("wb") as f:
+        # Serialize dates etc with str(), like json.dump(default=str)
+        f.write(orjson.dumps(data, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS))
+        # Make sure the data is on disk before the old file is replaced, so a crash cannot leave an empty file
+        f.flush()
+        os.fsync(f.fileno())
+    # os.replace() overwrites an existing file atomically, also on Windows where rename() fails
+    os.replace(tmp_path, outfile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,18 @@
+"""Test setup for the parse scripts."""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+PARSE_DIR = Path(__file__).resolve().parent.parent
+
+# The parse scripts are run from the parse directory and import each other as top level modules
+sys.path.insert(0, str(PARSE_DIR))
+
+# gen_pids reads the Datacite credentials from ~/.netrc when it is imported, so give it a dummy one
+_home = tempfile.mkdtemp(prefix="metadata-api-test-")
+_netrc = Path(_home) / ".netrc"
+_netrc.write_text("machine datacite.org login test account test password test\n", encoding="utf-8")
+_netrc.chmod(0o600)
+os.environ["HOME"] = _home
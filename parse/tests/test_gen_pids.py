@@ -0,0 +1,57 @@
+"""Tests for gen_pids.py."""
+
+import markdown
+import pytest
+from bs4 import BeautifulSoup
+
+import gen_pids
+
+# Descriptions that a simplified Markdown cleaner has got wrong before
+MARKDOWN_STRINGS = [
+    "Se <https://spraakbanken.gu.se/x> för info",
+    "a < b > c",
+    r"\*stars\*",
+    "- one\n- two\n\n1. first\n2. second",
+    "> quoted\n> more",
+    "para\n\n---\n\nafter",
+    "use ``a`b`` here",
+    "_emphasis_ and __strong__ and *e* **s**",
+    "Para one\nline two\n\nPara two\n\n\n\nPara three",
+    "# Head\n\nText with [link](http://x) and <b>bold</b> &amp; `co<de>`\n\n```xml\n<a>x</a>\n```\n\nEnd",
+]
+
+
+def markdown_text(string):
+    """Clean string the straightforward way, with a new Markdown instance every time."""
+    md = gen_pids.MD_FENCE_LANG_RE.sub(r"\1", string)
+    text = BeautifulSoup(markdown.markdown(md), "html.parser").get_text()
+    return gen_pids.BLANK_LINES_RE.sub("\n\n", text)
+
+
+@pytest.mark.parametrize("string", MARKDOWN_STRINGS)
+def test_get_clean_string_matches_markdown(string):
+    assert gen_pids.get_clean_string(string) == markdown_text(string)
+
+
+def test_get_clean_string_keeps_text():
+    assert gen_pids.get_clean_string("Se <https://spraakbanken.gu.se/x> för info") == (
+        "Se https://spraakbanken.gu.se/x för info"
+    )
+    assert gen_pids.get_clean_string("a < b > c") == "a < b > c"
+    assert gen_pids.get_clean_string(r"\*stars\*") == "*stars*"
+
+
+def test_get_clean_string_resets_markdown():
+    # A reference definition in one description must not turn text in the next one into a link
+    gen_pids.get_clean_string("[ref]: https://spraakbanken.gu.se/")
+    assert gen_pids.get_clean_string("[ref]") == "[ref]"
+
+
+def test_get_slug_dois_skips_incomplete_records():
+    records = [
+        {"id": "10.1/a", "attributes": {"identifiers": [{"identifierType": "slug", "identifier": "a"}]}},
+        {"id": "10.1/b", "attributes": {"identifiers": None}},
+        {"id": "10.1/c", "attributes": None},
+        {"attributes": {"identifiers": [{"identifierType": "slug", "identifier": "d"}]}},
+    ]
+    assert gen_pids.get_slug_dois(records) == {"a": "10.1/a"}
@@ -0,0 +1,57 @@
+"""Tests for parse_yaml."""
+
+import json
+
+from parse_yaml import get_schema_hash, get_yaml, init_yaml_worker
+
+
+def write_schemas(tmp_path, schemas):
+    for name, schema in schemas.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(schema))
+    return json.loads((tmp_path / "metadata.json").read_text())
+
+
+def test_schema_hash_includes_referenced_files(tmp_path):
+    schemas = {
+        "metadata.json": {"properties": {"size": {"$ref": "defs/size.json#/definitions/size"}}},
+        "defs/size.json": {"definitions": {"size": {"$ref": "number.json"}}},
+        "defs/number.json": {"type": "integer"},
+    }
+    schema = write_schemas(tmp_path, schemas)
+    schema_hash = get_schema_hash(schema, tmp_path)
+    assert schema_hash is not None
+    assert get_schema_hash(schema, tmp_path) == schema_hash
+
+    # Changing a file referenced from a referenced file changes the hash
+    (tmp_path / "defs/number.json").write_text(json.dumps({"type": "number"}))
+    assert get_schema_hash(schema, tmp_path) != schema_hash
+
+
+def test_schema_hash_ignores_local_refs(tmp_path):
+    schema = write_schemas(tmp_path, {"metadata.json": {"$defs": {"a": {}}, "properties": {"a": {"$ref": "#/$defs/a"}}}})
+    assert get_schema_hash(schema, tmp_path) is not None
+
+
+def test_schema_hash_unknown_refs(tmp_path):
+    schema = write_schemas(tmp_path, {"metadata.json": {"properties": {"a": {"$ref": "https://example.com/a.json"}}}})
+    assert get_schema_hash(schema, tmp_path) is None
+    schema = write_schemas(tmp_path, {"metadata.json": {"properties": {"a": {"$ref": "missing.json"}}}})
+    assert get_schema_hash(schema, tmp_path) is None
+
+
+def test_get_yaml_reports_best_match_error(tmp_path, capsys):
+    schema = {
+        "type": "object",
+        # "properties" is checked before "required", but best_match prefers the missing property
+        "properties": {"a": {"type": "integer"}},
+        "required": ["name"],
+    }
+    filepath = tmp_path / "res.yaml"
+    filepath.write_text("type: corpus\na: x\n")
+    init_yaml_worker(schema)
+    resources, _, _, valid_hashes = get_yaml(filepath, validate=True)
+    assert resources == {}
+    assert valid_hashes == {}
+    assert "'name' is a required property" in capsys.readouterr().err
@@ -1,5 +1,6 @@
 """Module for translating iso639-3 language codes into language names."""
 
+from functools import lru_cache
 import gettext
 
 import pycountry
@@ -7,6 +8,7 @@ import pycountry
 SWEDISH = gettext.translation("iso639-3", pycountry.LOCALES_DIR, languages=["sv"])
 
 
+@lru_cache(maxsize=None)
 def get_lang_names(langcode):
     """Get English and Swedish name for language represented by langcode."""
     l = pycountry.languages.get(alpha_3=langcode)